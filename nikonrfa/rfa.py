@@ -6,7 +6,7 @@ This module defines a class that simplifies interacting with the RFA.
 
 Implemented commands:
 w   MZ XXXX     abs move
-r   RESOLUTION  in an underscore method (called in __init__)
+r   RESOLUTION  refresh_resolution (called in __init__, unless cached for the device)
 r   VERSION     no dedicated method, but used in __init__
 r   WHO         no dedicated method, but used in __init__
 r   WZ          read position
@@ -31,12 +31,47 @@ Not (yet) implemented commands
 
 import serial  # pip install pyserial
 from serial.tools import list_ports
+from contextlib import contextmanager
 import logging
+import numbers
 import time
 
+logging.getLogger(__name__).addHandler(logging.NullHandler())
+
+_COMPORTS_TTL_S = 1
+_comports_cache = (None, [])  # (time of enumeration, list of ports)
+
+
+def _comports():
+    """
+    Returns list_ports.comports(), reusing the result if it was enumerated less than _COMPORTS_TTL_S ago
+    (enumerating the ports is slow on Windows).
+    """
+    global _comports_cache
+    t, ports = _comports_cache
+    if t is None or time.monotonic() - t > _COMPORTS_TTL_S:
+        ports = list_ports.comports()
+        _comports_cache = (time.monotonic(), ports)
+    return ports
+
 
 class NikonRFA:
-    def __init__(self, port=None, newline=b'\r', timeout=2, vid=None, pid=None, *args, **kwargs):
+    # Pre-encoded command prefixes for the move commands:
+    _CMD_MZ = b'MZ '
+    _CMD_RZ = b'RZ '
+    _CMD_HZ = b'HZ '
+    _TERM = b'\r'
+    # Commands (upper case) without a meaningful reply, which may be used inside a batch() block:
+    _BATCHABLE = (_CMD_MZ, _CMD_RZ, _CMD_HZ, b'SPEED ', b'MINSPEED ', b'RAMPSLOPE ', b'ENCODER ON\r', b'ENCODER OFF\r',
+                  b'ZERO\r', b'HALT\r')
+
+    # Resolution info per device, shared by all instances so that reconnecting skips the RESOLUTION query.
+    # Maps (vid, pid, serial_number) to (smallest_um_step, units_per_um). Only devices found by vid and pid that have a
+    # USB serial number are cached: port names get reassigned and chips like the CH340 don't report a serial number,
+    # so those keys could belong to another device (with another resolution).
+    _resolution_cache = {}
+
+    def __init__(self, port=None, newline=b'\r', timeout=2, vid=None, pid=None, low_latency=True, *args, **kwargs):
         """
         Control the Nikon Remote Focus Accessory (RFA).
         Specify either the COM-port or search for the COM-port automatically by specifying
@@ -49,31 +84,41 @@ class NikonRFA:
         :param float timeout: Read timeout in seconds (optional, default: 2)
         :param int vid: The serial-chip vendor id number (optional, default: None)
         :param int pid: The serial-chip product id number (optional, default: None)
+        :param bool low_latency: Enable low latency mode on the serial port (optional, default: True)
         :param *args: Additional arguments are passed to pyserial Serial object (optional)
         :param **kwargs: Additional keyword arguments are passed to pyserial Serial object (optional)
         """
         self.logger = logging.getLogger(__name__)
         self._line_ending = newline
-        self._timeout = timeout
+        self._batching = False      # Used by batch() to collect commands instead of sending them one by one
+        self._batch_commands = []
+        self._buffer_clean = False  # False if a stale (late) reply may be waiting in the input buffer
 
         self.unit = 'um'
 
         # If port is not specified, find the device by vid and pid:
+        self._device_key = None     # key in _resolution_cache (None: don't cache)
         if port is None:
-            if type(vid) is not int or type(pid) is not int:
+            if not (isinstance(vid, numbers.Integral) and isinstance(pid, numbers.Integral)):
                 self.logger.error("If port is not supplied, vid and pid need to be supplied (ints)")
             else:
-                matches = [d.device for d in list_ports.comports() if d.vid==vid and d.pid==pid]
+                matches = [d for d in _comports() if d.vid==vid and d.pid==pid]
                 if len(matches) == 0:
-                    self.logger.error('No match found for vid={} pis={}'.format(vid, pid))
+                    self.logger.error('No match found for vid=%s pid=%s', vid, pid)
                     return
                 elif len(matches)>1:
                     self.logger.warning('Multiple matches found. Using first one')
-                else:
-                    port = matches[0]
-        self.ser = serial.Serial()
-        self.ser.port = port  #, , **kwargs)
-        self.ser.timeout = timeout
+                port = matches[0].device
+                if matches[0].serial_number is not None:
+                    self._device_key = (matches[0].vid, matches[0].pid, matches[0].serial_number)
+        kwargs.setdefault('write_timeout', timeout)
+        kwargs.setdefault('exclusive', True)    # prevents other processes from interleaving commands on the port
+        kwargs.setdefault('rtscts', False)      # the RFA uses no flow control
+        kwargs.setdefault('xonxoff', False)
+        # The timeout bounds every read (read_until returns what it got when it expires).
+        # The port is set afterwards, so that it's opened below (with retries) instead of directly:
+        self.ser = serial.Serial(None, *args, timeout=timeout, **kwargs)
+        self.ser.port = port
 
         for k in range(5):
             try:
@@ -86,27 +131,83 @@ class NikonRFA:
             self.ser.close()
             time.sleep(1)
 
+        if low_latency and self.ser.is_open:
+            self._set_low_latency()
+
         time.sleep(1)
-        idn = self.query('WHO')
+        # The handshake queries are sent in one go (RESOLUTION is skipped if it's cached for this device):
+        commands = ['WHO', 'VERSION', 'RESOLUTION', 'ENCODER', 'WZ']
+        cached_resolution = self._resolution_cache.get(self._device_key)
+        if cached_resolution is not None:
+            commands.remove('RESOLUTION')
+        replies = dict(zip(commands, self._pipelined_query(commands, self._handshake_reply_valid)))
+        idn = replies['WHO']
         if idn == 'Remote Focus Accessory (M)':
-            ver = self.query('VERSION')
-            self.logger.info("Connected to {}, firmware: {}".format(idn, ver))
+            self.logger.info("Connected to %s, firmware: %s", idn, replies['VERSION'])
         else:
             self.logger.warning('Device did not identify')
 
         # Initialize internal variables (directly and through functions):
-        self._get_resolution_info() # initializes:
+        if cached_resolution is None:   # initializes:
+            if not self._update_resolution(replies['RESOLUTION']):
+                raise serial.SerialException('Could not retrieve the resolution from the device (reply: {})'.format(
+                    replies['RESOLUTION']))
+        else:
+            self._set_resolution(*cached_resolution)
         # _units_per_um             This contains the scaling factor between um and the units the device uses for
         #                           communication. I.e. how much units fit in a micrometer.
         # _smallest_um_step         The smallest step in um. Note that the device will return 0 for values smaller than 1
         #                           One may overwrite this parameter using the smallest_um attribute.
-        if not self._get_encoder_status():
+        if self._parse_encoder_status(replies['ENCODER']):
+            self._update_position(replies['WZ'])    # initializes:
+        else:
             self._set_encoder_status(True)
-        self.get_position()         # initializes:
+            self.get_position()                     # initializes:
         # _pos                      Stores the last retrieved position
         self._moved_since_last_read = True  # Used to keep track if the stages has moved since last position read
         self.default_wait_s = 0
 
+    def _handshake_reply_valid(self, command, reply):
+        """
+        Checks whether a reply to the init handshake has the expected shape for its command. Used to detect that
+        pipelined replies got shifted (e.g. because the device dropped a command). The WHO reply is not checked:
+        whether the device identified is only a warning.
+
+        :param str command: command that was sent
+        :param str reply: reply from the device
+        :return: True if the reply has the expected shape
+        :rtype: bool
+        """
+        if command == 'VERSION':
+            return bool(reply)
+        if command == 'RESOLUTION':
+            return self._parse_resolution(reply) is not None
+        if command == 'ENCODER':
+            return reply in ('ON', 'OFF')
+        if command == 'WZ':
+            try:
+                int(reply)
+            except (TypeError, ValueError):
+                return False
+        return True
+
+    def _set_low_latency(self):
+        """
+        Reduces the latency of the serial port. Every command waits for a reply, so the USB latency timer (16 ms by
+        default on FTDI chips) otherwise dominates each query.
+        On Linux this is equivalent to: setserial /dev/ttyUSB0 low_latency
+        On Windows the driver buffers are set instead.
+        """
+        try:
+            self.ser.set_low_latency_mode(True)
+        except (NotImplementedError, OSError, AttributeError, ValueError):
+            self.logger.debug('low latency mode unavailable')
+        if hasattr(self.ser, 'set_buffer_size'):  # only available on Windows
+            try:
+                self.ser.set_buffer_size(rx_size=4096, tx_size=4096)
+            except (OSError, serial.SerialException):
+                self.logger.debug('could not set buffer size')
+
     def _get_encoder_status(self):
         """
         Retrieves the status of the encoder.
@@ -114,11 +215,19 @@ class NikonRFA:
         :return: encoder status
         "rtype bool:
         """
+        return self._parse_encoder_status(self.query('ENCODER'))
+
+    def _parse_encoder_status(self, reply):
+        """
+        Interprets the reply to the ENCODER query.
 
-        reply = self.query('ENCODER')
+        :param str reply: reply from the device
+        :return: encoder status
+        "rtype bool:
+        """
         if reply=='OFF':
             return False
-        elif reply == 'ON ':
+        elif reply == 'ON':
             return True
         else:
             self.logger.warning('Unknown response')
@@ -133,22 +242,32 @@ class NikonRFA:
             reply = self.query('ENCODER ON')
         else:
             reply = self.query('ENCODER OFF')
-        self.logger.debug('Setting encoder status {}'.format(status))
+        self.logger.debug('Setting encoder status %s', status)
 
-    def absmove(self, um, wait_s):
+    def absmove(self, um, wait_s=None, read_back=False):
         """
         Move to absolute position (in um).
+        With read_back=True the position is read from the device after waiting and returned, which avoids a
+        separate read through the pos property. (Don't use read_back inside a batch() block.)
 
         :param float um: position to move to (in um)
+        :param float wait_s: time to wait after sending the command in s (optional, default: default_wait_s)
+        :param bool read_back: read out the position after the move and return it (optional, default: False)
+        :return: position in um if read_back is True, otherwise None
+        :rtype: float
         """
-        reply = self.query('MZ {}'.format(int(round(um*self._units_per_um))))
+        reply = self._write_int_cmd(self._CMD_MZ, self._um_to_units(um))
         if reply:
-            self.logger.warning('unexpected message: '+reply)
+            self.logger.warning('unexpected message: %s', reply)
         self._moved_since_last_read = True
-        if wait_s is None:
+        if self._batching:
+            pass    # the command is only queued, waiting now would delay sending it
+        elif wait_s is None:
             time.sleep(self.default_wait_s)
         else:
             time.sleep(wait_s)
+        if read_back:
+            return self.get_position()
 
     def absmove_read(self, um):
         """
@@ -160,10 +279,10 @@ class NikonRFA:
         :rtype: float
         """
         pos_before_move = self.pos
-        self.absmove(um)
-        if self.pos == pos_before_move:
+        new_pos = self.absmove(um, read_back=True)
+        if new_pos == pos_before_move:
             self.logger.warning("Stage didn't move. Perhaps step too small or out of range.")
-        return self.pos
+        return new_pos
 
     def get_position(self):
         """
@@ -172,30 +291,49 @@ class NikonRFA:
         :return: position in um (retrieved from device)
         :rtype: float
         """
-        reply = self.query('WZ')
+        return self._update_position(self.query('WZ'))
+
+    def _update_position(self, reply):
+        """
+        Interprets the reply to the WZ query and updates internal memory. And returns the position.
+
+        :param str reply: reply from the device
+        :return: position in um
+        :rtype: float
+        """
         try:
             pos = int(reply) / self._units_per_um
             self._pos = pos
             self._moved_since_last_read = False
             return pos
         except:
-            self.logger.warning('unexpected message: '+reply)
+            self.logger.warning('unexpected message: %s', reply)
 
 
-    def relmove(self, um, wait_s=None):
+    def relmove(self, um, wait_s=None, read_back=False):
         """
         Move by relative position from the curent position (in um).
+        With read_back=True the position is read from the device after waiting and returned, which avoids a
+        separate read through the pos property. (Don't use read_back inside a batch() block.)
 
         :param float um: relative position to move to (in um)
+        :param float wait_s: time to wait after sending the command in s (optional, default: default_wait_s)
+        :param bool read_back: read out the position after the move and return it (optional, default: False)
+        :return: position in um if read_back is True, otherwise None
+        :rtype: float
         """
-        reply = self.query('RZ {}'.format(int(round(um*self._units_per_um))))
+        reply = self._write_int_cmd(self._CMD_RZ, self._um_to_units(um))
         if reply:
-            self.logger.warning('unexpected message: '+reply)
+            self.logger.warning('unexpected message: %s', reply)
         self._moved_since_last_read = True
-        if wait_s is None:
+        if self._batching:
+            pass    # the command is only queued, waiting now would delay sending it
+        elif wait_s is None:
             time.sleep(self.default_wait_s)
         else:
             time.sleep(wait_s)
+        if read_back:
+            return self.get_position()
 
     def relmove_read(self, um):
         """
@@ -207,10 +345,10 @@ class NikonRFA:
         :rtype: float
         """
         pos_before_move = self.pos
-        self.relmove(um)
-        if self.pos == pos_before_move:
+        new_pos = self.relmove(um, read_back=True)
+        if new_pos == pos_before_move:
             self.logger.warning("Stage didn't move. Perhaps step too small or out of range.")
-        return self.pos
+        return new_pos
 
     @property
     def pos(self):
@@ -229,19 +367,70 @@ class NikonRFA:
         else:
             return self._pos
 
-    def _get_resolution_info(self):
+    def refresh_resolution(self):
         """
-        Retrieves the resolution information from the device and stores those internally.
+        Retrieves the resolution information from the device (ignoring the cache), stores those internally and
+        updates the cache.
         Note that this will set/overwrite smallest_um_step.
         """
-        reply = self.query('RESOLUTION')
-        number, fraction = reply.split(' ')
-        if fraction  == 'HUNDREDTHS':
-            self._units_per_um = 100.0
-        elif fraction  == 'TENTHS':
-            self._units_per_um = 10.0
-        self._smallest_um_step = int(number)
-        self.logger.info("Setting smallest_um_step to {}".format(self._smallest_um_step))
+        self._update_resolution(self.query('RESOLUTION'))
+
+    def _update_resolution(self, reply):
+        """
+        Interprets the reply to the RESOLUTION query, stores the information internally and updates the cache.
+        If the reply can't be interpreted, the stored information is left unchanged.
+
+        :param str reply: reply from the device
+        :return: True if the reply was interpreted
+        :rtype: bool
+        """
+        resolution = self._parse_resolution(reply)
+        if resolution is None:
+            self.logger.warning('unexpected resolution message: %s', reply)
+            return False
+        self._set_resolution(*resolution)
+        if self._device_key is not None:
+            self._resolution_cache[self._device_key] = resolution
+        return True
+
+    @staticmethod
+    def _parse_resolution(reply):
+        """
+        Interprets the reply to the RESOLUTION query.
+
+        :param str reply: reply from the device
+        :return: (smallest_um_step, units_per_um), or None if the reply isn't a resolution
+        :rtype: tuple
+        """
+        try:
+            number, fraction = reply.split()
+            return int(number), {'HUNDREDTHS': 100, 'TENTHS': 10}[fraction]
+        except (AttributeError, ValueError, KeyError):
+            return None
+
+    def _set_resolution(self, smallest_um_step, units_per_um):
+        """
+        Stores the resolution information internally.
+
+        :param int smallest_um_step: smallest step in um
+        :param int units_per_um: number of device units per um (10 or 100)
+        """
+        self._units_per_um = float(units_per_um)
+        self._units_per_um_int = units_per_um
+        self._smallest_um_step = smallest_um_step
+        self.logger.info("Setting smallest_um_step to %s", self._smallest_um_step)
+
+    def _um_to_units(self, um):
+        """
+        Converts um to the (integer) units the device uses for communication. Rounds half away from zero.
+
+        :param float um: value in um
+        :return: value in device units
+        :rtype: int
+        """
+        if isinstance(um, int):
+            return um * self._units_per_um_int
+        return int(um * self._units_per_um_int + (0.5 if um >= 0 else -0.5))
 
     @property
     def smallest_um_step(self):
@@ -258,28 +447,156 @@ class NikonRFA:
     @smallest_um_step.setter
     def smallest_um_step(self, um_step):
         if um_step != self._smallest_um_step:
-            self.logger.info("Modifying smallest_um_step from {} to {}".format(self._smallest_um_step, um_step))
+            self.logger.info("Modifying smallest_um_step from %s to %s", self._smallest_um_step, um_step)
             self._smallest_um_step = um_step
 
     def query(self, command):
         """
         Send message to the device and waits for reply. Cleans up the reply and returns it.
+        Inside a batch() block the command is only collected and None is returned (see batch()).
 
         :param str command: command to send to the device
         :return: reply from the device
         :rtype: str
         """
+        return self._send((command + '\r').encode('ascii'))
+
+    def _write_int_cmd(self, prefix, n):
+        """
+        Fast path of query() for commands that take a single integer argument (e.g. moves).
+
+        :param bytes prefix: pre-encoded command prefix, including the separating space (e.g. _CMD_MZ)
+        :param int n: argument of the command
+        :return: reply from the device
+        :rtype: str
+        """
+        return self._send(prefix + str(n).encode('ascii') + self._TERM)
+
+    def _send(self, line):
+        """
+        Writes a complete command line (in a single write) and reads the reply.
+        Inside a batch() block the line is only collected and None is returned. Commands with a meaningful reply
+        raise a RuntimeError there, since their reply can't be returned.
+
+        :param bytes line: encoded command, including the terminator
+        :return: reply from the device
+        :rtype: str
+        """
+        if self._batching:
+            if not line.upper().startswith(self._BATCHABLE):
+                raise RuntimeError('{} has a reply, it can not be used inside a batch'.format(
+                    line.decode('ascii').strip()))
+            self._batch_commands.append(line)
+            return None
+        if not self._buffer_clean:
+            self._drain()
+        self.ser.write(line)
+        return self._read_reply()
+
+    def _pipelined_query(self, commands, is_valid=None):
+        """
+        Sends several commands with a single write and reads the replies afterwards, so they cost one round trip.
+        The RFA handles the commands line by line. The replies are matched to the commands by their order, so should
+        a reply not arrive or not have the expected shape (e.g. because the device dropped a command and the later
+        replies shifted), the input buffer is drained and that command and the remaining ones are sent one by one
+        with query().
+
+        :param list commands: commands (str) to send to the device
+        :param is_valid: function(command, reply) that checks the shape of a reply (optional, default: None)
+        :return: replies from the device, in the order of the commands
+        :rtype: list
+        """
+        if not self._buffer_clean:
+            self._drain()
+        self.ser.write(b''.join((command + '\r').encode('ascii') for command in commands))
+        replies = []
+        for command in commands:
+            reply = self._read_reply()
+            if reply is None:
+                break
+            if is_valid is not None and not is_valid(command, reply):
+                self.logger.debug('Unexpected reply to pipelined %s: %s', command, reply)
+                time.sleep(0.1)     # let the replies to the remaining commands arrive, so they are drained as well
+                self._drain()
+                break
+            replies.append(reply)
+        if len(replies) < len(commands):
+            self.logger.warning('Pipelined replies did not match the commands, sending %s one by one',
+                                ', '.join(commands[len(replies):]))
+        for command in commands[len(replies):]:
+            replies.append(self.query(command))
+        return replies
+
+    def _read_reply(self):
+        """
+        Reads a single reply from the device and cleans it up.
+
+        :return: reply from the device (None on timeout)
+        :rtype: str
+        """
+        # A single read_until call (bounded by the serial timeout) instead of reading byte by byte:
+        raw = self.ser.read_until(expected=self._line_ending)
+        if not raw.endswith(self._line_ending):
+            self.logger.warning('timeout waiting for reply')
+            # The reply may still arrive later, so clear the input buffer now and again before the next command:
+            self.ser.reset_input_buffer()
+            self._buffer_clean = False
+            return None
+        # Strip the terminator and a line feed following the previous reply that may still be waiting in the buffer:
+        line = raw[:-len(self._line_ending)].strip().decode('ascii', errors='replace')
+        self.logger.debug(line)
+        # The reply consists of a status prefix (e.g. ':A'), a space and the payload (padded with spaces):
+        _, _, payload = line.partition(' ')
+        return payload.strip()
+
+    def _drain(self):
+        """
+        Discards anything waiting in the input buffer. The replies are read completely, so this is only needed when
+        unsolicited output is plausible, e.g. after halt() or reset().
+        """
         self.ser.reset_input_buffer()
-        self.ser.write((command + '\r').encode('ascii'))
-        buffer = ""
-        t0 = time.time()
-        while time.time() < t0 + self._timeout:
-            oneByte = self.ser.read(1)
-            if oneByte == b"\r":  # method should returns bytes
-                self.logger.debug(buffer)
-                return buffer[3:-1]
-            else:
-                buffer += oneByte.decode("ascii")
+        self._buffer_clean = True
+
+    @contextmanager
+    def batch(self):
+        """
+        Context manager that collects the commands sent inside the block and sends them with a single write when the
+        block is left. The replies are read afterwards, so configuring several parameters costs one round trip.
+        Only commands without a meaningful reply (moves, setters, ENCODER ON/OFF, zero, halt; see _BATCHABLE) can be
+        used inside the block. Others, like the getters, get_position() and moves with read_back=True, raise a
+        RuntimeError, in which case none of the collected commands are sent. The wait_s of moves is ignored inside the block (the commands are sent
+        back-to-back), so only batch moves that don't need to wait for each other.
+        If a reply doesn't arrive, the remaining replies aren't read and an error lists the commands that weren't
+        acknowledged. These are not resent (a relative move isn't safe to repeat), so check the position afterwards.
+
+        Example:
+            with rfa.batch():
+                rfa.maxspeed = 1000
+                rfa.rampslope = 10
+                rfa.relmove(100)
+        """
+        if self._batching:  # nested batch: the outer one sends everything
+            yield self
+            return
+        self._batching = True
+        self._batch_commands = []
+        try:
+            yield self
+        finally:
+            self._batching = False
+        if self._batch_commands:
+            if not self._buffer_clean:
+                self._drain()
+            self.ser.write(b''.join(self._batch_commands))
+            for k, command in enumerate(self._batch_commands):
+                reply = self._read_reply()
+                if reply is None:
+                    self.logger.error('No reply in batch, commands not acknowledged: %s',
+                                      ', '.join(c.decode('ascii').strip() for c in self._batch_commands[k:]))
+                    break
+                if reply:
+                    self.logger.warning('unexpected message for %s: %s', command.decode('ascii').strip(), reply)
+        self._batch_commands = []
 
     def close(self):
         """Closes the serial connection."""
@@ -307,6 +624,7 @@ class NikonRFA:
         self.logger.debug('setting the origin')
         self.query("zero")
         self._pos=0.00
+        self._moved_since_last_read = False
 
     def redefine_position(self,um):
         """
@@ -314,9 +632,10 @@ class NikonRFA:
 
         :param float um: the redefined position (um)
         """
-        self.logger.debug('redefining the current position to {}um'.format(um))
-        reply = self.query('HZ {}'.format(int(round(um * self._units_per_um))))
+        self.logger.debug('redefining the current position to %sum', um)
+        reply = self._write_int_cmd(self._CMD_HZ, self._um_to_units(um))
         self._pos=um
+        self._moved_since_last_read = False
 
     @property
     def maxspeed(self):
@@ -388,8 +707,10 @@ class DummyNikonRFA:
     def __init__(self, *args, **kwargs):
         self._pos = 0
 
-    def absmove(self, new_pos):
+    def absmove(self, new_pos, wait_s=None, read_back=False):
         self._pos = new_pos
+        if read_back:
+            return self._pos
 
     @property
     def pos(self):